@@ -0,0 +1,109 @@
+'''
+aws_inventory.py is a small shared module that the scripts in aws_multi_az
+and class-instances use to find their EC2 resources.
+
+Each kind of resource is fetched at most once per set of filters, with the
+filtering done server-side and all of the pages followed, and everything
+fetched is indexed by ID, tag, availability zone, and VPC so that scripts
+can look things up as often as they like without more describe_* calls.
+'''
+
+# resource type: (describe_* operation, key of the list in its response, ID field)
+RESOURCE_TYPES = {
+        'instance': ('describe_instances', 'Reservations', 'InstanceId'),
+        'vpc': ('describe_vpcs', 'Vpcs', 'VpcId'),
+        'subnet': ('describe_subnets', 'Subnets', 'SubnetId'),
+        'security-group': ('describe_security_groups', 'SecurityGroups', 'GroupId'),
+        'key-pair': ('describe_key_pairs', 'KeyPairs', 'KeyName'),
+}
+
+def tag_filter(key, *values):
+    '''
+    tag_filter() returns the server-side filter for resources that have the
+    tag key set to any of values
+    '''
+    return {'Name': 'tag:{}'.format(key), 'Values': list(values)}
+
+def tags(resource):
+    '''
+    tags() turns the list of {'Key':..., 'Value':...} dicts on a resource into a dict
+    '''
+    return {t['Key']: t['Value'] for t in resource.get('Tags', [])}
+
+class Inventory:
+    '''
+    Inventory holds every resource fetched with load(), indexed for find()
+    '''
+    def __init__(self, ec2):
+        self.ec2 = ec2
+        self.requests = {}
+        self.by_type = {t: {} for t in RESOURCE_TYPES}
+        self.index = {}
+
+    def load(self, resource_type, **kwargs):
+        '''
+        load() fetches all resources of resource_type that match kwargs,
+        which are passed as-is to the describe_* call (e.g. Filters), and
+        returns them. Loading the same thing twice doesn't call AWS again.
+        '''
+        operation, key, id_field = RESOURCE_TYPES[resource_type]
+        request = (resource_type, repr(sorted(kwargs.items())))
+        if request in self.requests:
+            return self.find(resource_type, _ids=self.requests[request])
+
+        if self.ec2.can_paginate(operation):
+            pages = self.ec2.get_paginator(operation).paginate(**kwargs)
+        else:
+            pages = [getattr(self.ec2, operation)(**kwargs)]
+        found = {}
+        for page in pages:
+            for item in page[key]:
+                # describe_instances is the odd one out, with instances
+                # grouped into reservations
+                for resource in item['Instances'] if resource_type == 'instance' else [item]:
+                    found[resource[id_field]] = None
+                    self.add(resource_type, resource)
+        self.requests[request] = found
+        return self.find(resource_type, _ids=found)
+
+    def add(self, resource_type, resource):
+        '''
+        add() puts a single resource into the inventory, for instance one
+        that was just created or one whose state has changed
+        '''
+        resource_id = resource[RESOURCE_TYPES[resource_type][2]]
+        self.by_type[resource_type][resource_id] = resource
+        keys = [('tag', k, v) for k, v in tags(resource).items()]
+        az = resource.get('AvailabilityZone', resource.get('Placement', {}).get('AvailabilityZone'))
+        if az:
+            keys.append(('az', az))
+        if resource.get('VpcId'):
+            keys.append(('vpc', resource['VpcId']))
+        for k in keys:
+            self.index.setdefault((resource_type,) + k, {})[resource_id] = None
+
+    def get(self, resource_id, resource_type=None):
+        '''
+        get() returns the resource with the given ID, or None
+        '''
+        for t in [resource_type] if resource_type else RESOURCE_TYPES:
+            if resource_id in self.by_type[t]:
+                return self.by_type[t][resource_id]
+        return None
+
+    def find(self, resource_type, az=None, vpc=None, _ids=None, **tag_values):
+        '''
+        find() returns the loaded resources of resource_type that are in az
+        and vpc (if given) and that have all of the tags in tag_values,
+        e.g. find('subnet', vpc='vpc-abc', CourseId='my-class-123')
+        '''
+        keys = [('tag', k, v) for k, v in tag_values.items()]
+        if az:
+            keys.append(('az', az))
+        if vpc:
+            keys.append(('vpc', vpc))
+        ids = self.by_type[resource_type] if _ids is None else _ids
+        for k in keys:
+            matching = self.index.get((resource_type,) + k, {})
+            ids = [i for i in ids if i in matching]
+        return [self.by_type[resource_type][i] for i in ids]
@@ -1,10 +1,38 @@
 #!/usr/bin/env python3
-import ipaddress, os, sys
+import argparse, ipaddress, os, sys
 from collections import defaultdict
 
 import boto3
 import yaml
 
+import aws_inventory
+import disk_cache
+
+def ratios(value):
+    '''
+    ratios() parses --ratio, e.g. "tikv=3,tidb=1,tiflash=0"
+    '''
+    result = {}
+    for part in value.split(','):
+        role, _, weight = part.partition('=')
+        if role not in ('tikv', 'tidb', 'tiflash'):
+            raise argparse.ArgumentTypeError('unknown role {!r}'.format(role))
+        try:
+            result[role] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError('bad weight {!r} for {}'.format(weight, role))
+    return result
+
+parser = argparse.ArgumentParser(description='Print a TiUP topology for the instances of $CLUSTER_NAME')
+parser.add_argument('--ratio', type=ratios, default='tikv=3,tidb=1,tiflash=0',
+        help='How to share the vCPUs of the cluster between roles (default %(default)s)')
+parser.add_argument('--pd-count', type=int, default=3,
+        help='The number of PD servers (default %(default)d)')
+parser.add_argument('--haproxy', type=str, metavar='FILE',
+        help='Also write an haproxy.conf that balances over the TiDB servers to FILE')
+
+args = parser.parse_args()
+
 if os.getenv('CLUSTER_NAME'):
     cluster_name = os.getenv('CLUSTER_NAME')
 else:
@@ -12,15 +40,17 @@ else:
     sys.exit(1)
 
 ec2 = boto3.client('ec2')
+inventory = aws_inventory.Inventory(ec2)
 
-instance_info = ec2.describe_instances(Filters = [        {
-    'Name': 'tag:Name', 'Values': [ cluster_name, ] },])
+inventory.load('instance', Filters=[aws_inventory.tag_filter('Name', cluster_name),
+    {'Name': 'instance-state-name', 'Values': ['pending', 'running']}])
 
 instance_details = defaultdict(list)
-# [d[i['Placement']['AvailabilityZone']].append(i) for r in [r['Instances'] for r in instance_info['Reservations']] for i in r]
-for r in instance_info['Reservations']:
-    for i in r['Instances']:
-        instance_details[i['Placement']['AvailabilityZone']].append(i)
+for i in inventory.find('instance', Name=cluster_name):
+    instance_details[i['Placement']['AvailabilityZone']].append(i)
+if not instance_details:
+    print('No pending or running instances in cluster {}'.format(cluster_name), file=sys.stderr)
+    sys.exit(1)
 
 template_yaml = '''
 global:
@@ -40,27 +70,105 @@ grafana_servers: []
 alertmanager_servers: []
 '''
 
+haproxy_template = '''listen tidb
+    bind 127.0.0.1:4000
+    mode tcp
+    option mysql-check user root
+    balance roundrobin
+    timeout connect 3000
+    timeout server 10800s
+    timeout client 10800s
+'''
+
 template = yaml.safe_load(template_yaml)
 
 def host(instance, **kwargs):
     return {'host':instance['PrivateIpAddress'], **kwargs}
 
-management_node=''
-for k in sorted(instance_details.keys()):
-    for i, instance in enumerate(sorted(instance_details[k], key=lambda x: ipaddress.ip_address(x['PrivateIpAddress']))):
-        # First node will be our "management node", where TiUP and monitoring will be installed
-        if management_node == '':
-            for section in ['monitoring_servers', 'grafana_servers', 'alertmanager_servers']:
-                management_node = instance['PublicIpAddress']
-                template[section].append(host(instance))
-        # After management node is defined, the "first" node in each AZ will be a tidb/pd node
-        elif i==0:
-            for section in ['tidb_servers', 'pd_servers']:
-                template[section].append(host(instance))
-        # All other nodes will be tikv nodes
-        else:
-            template['tikv_servers'].append(host(instance, config={'server.labels': {'zone': instance['Placement']['AvailabilityZone']}}))
+def zone(instance):
+    return instance['Placement']['AvailabilityZone']
+
+def instance_type_capacity(instance_type):
+    '''
+    instance_type_capacity() returns [vCPUs, memory in MiB] for an instance
+    type, which only changes if AWS changes the type, so it's cached for a month
+    '''
+    def lookup():
+        info = ec2.describe_instance_types(InstanceTypes=[instance_type])['InstanceTypes'][0]
+        return [info['VCpuInfo']['DefaultVCpus'], info['MemoryInfo']['SizeInMiB']]
+    return disk_cache.cached('instance-type:' + instance_type, 30 * 24 * 3600, lookup)
+
+capacity = {t: instance_type_capacity(t)
+        for t in sorted({i['InstanceType'] for i in inventory.find('instance', Name=cluster_name)})}
+vcpus = lambda instance: capacity[instance['InstanceType']][0]
+memory = lambda instance: capacity[instance['InstanceType']][1]
+
+# Instances left to place, per AZ, in IP order
+remaining = {az: sorted(instances, key=lambda x: ipaddress.ip_address(x['PrivateIpAddress']))
+        for az, instances in sorted(instance_details.items())}
+
+# First node will be our "management node", where TiUP and monitoring will be installed
+management = remaining[min(remaining)].pop(0)
+management_node = management['PublicIpAddress']
+for section in ['monitoring_servers', 'grafana_servers', 'alertmanager_servers']:
+    template[section].append(host(management))
+
+# Each role gets its share of the rest of the cluster's vCPUs. The smaller
+# roles are placed first, one instance at a time, each time from the AZ
+# that has the most instances left, which keeps what is left over for the
+# largest role (TiKV by default) evenly spread across the AZs.
+total_vcpus = sum(vcpus(i) for instances in remaining.values() for i in instances)
+total_weight = sum(args.ratio.values())
+roles = sorted((r for r in args.ratio if args.ratio[r] > 0), key=lambda r: args.ratio[r])
+placed = defaultdict(list)
+for role in roles[:-1]:
+    target = total_vcpus * args.ratio[role] / total_weight
+    # TiFlash wants memory, the others want CPU
+    size = memory if role == 'tiflash' else vcpus
+    while any(remaining.values()):
+        az = max(remaining, key=lambda az: (len(remaining[az]), -len([i for i in placed[role] if zone(i) == az])))
+        candidate = max(remaining[az], key=size)
+        # Stop once adding another instance would overshoot more than it helps,
+        # but every role with a share gets at least one
+        assigned = sum(vcpus(i) for i in placed[role])
+        if placed[role] and assigned + vcpus(candidate) / 2 > target:
+            break
+        remaining[az].remove(candidate)
+        placed[role].append(candidate)
+if roles:
+    placed[roles[-1]] = [i for az in sorted(remaining) for i in remaining[az]]
+
+for instance in placed['tidb']:
+    template['tidb_servers'].append(host(instance))
+for instance in placed['tikv']:
+    template['tikv_servers'].append(host(instance, config={'server.labels': {'zone': zone(instance)}}))
+for instance in placed['tiflash']:
+    template['tiflash_servers'].append(host(instance, learner_config={'server.labels': {'zone': zone(instance)}}))
+
+# PD goes alongside TiDB where it can, one per AZ before doubling up
+pd = []
+candidates = placed['tidb'] + placed['tikv'] + placed['tiflash'] + [management]
+while len(pd) < min(args.pd_count, len(candidates)):
+    pd_zones = [zone(i) for i in pd]
+    instance = min((i for i in candidates if i not in pd),
+            key=lambda i: (pd_zones.count(zone(i)), candidates.index(i)))
+    pd.append(instance)
+    template['pd_servers'].append(host(instance))
 
 print(yaml.dump(template))
+
+if args.haproxy:
+    with open(args.haproxy, 'w') as f:
+        f.write(haproxy_template)
+        for n, instance in enumerate(placed['tidb'], 1):
+            f.write('    server tidb-{} {}:4000 check\n'.format(n, instance['PrivateIpAddress']))
+
+for role in ['pd'] + roles:
+    servers = pd if role == 'pd' else placed[role]
+    per_zone = defaultdict(int)
+    for i in servers:
+        per_zone[zone(i)] += 1
+    print('{}: {} ({})'.format(role, len(servers),
+        ', '.join('{} {}'.format(az, n) for az, n in sorted(per_zone.items()))), file=sys.stderr)
 print('echo \'curl --proto =https --tlsv1.2 -sSf https://tiup-mirrors.pingcap.com/install.sh | sh\' |', file=sys.stderr)
 print('ssh -o StrictHostKeyChecking=accept-new {}@{}'.format('ubuntu', management_node), file=sys.stderr)
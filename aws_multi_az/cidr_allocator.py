@@ -0,0 +1,84 @@
+'''
+cidr_allocator.py finds free address blocks for new subnets inside a VPC's
+CIDR range, used by deploy_instances.py and class-instances/create-instances.py.
+
+Instead of listing every possible subnet of the new size and guessing an
+offset into that list, it keeps a sorted list of the ranges that are already
+in use (merged where they touch) and looks for the first aligned block of
+the requested size in the gaps between them. Existing subnets can have any
+mix of prefix lengths, and IPv6 ranges work the same way as IPv4.
+'''
+
+import bisect
+import ipaddress
+
+class CidrAllocator:
+    '''
+    CidrAllocator hands out free blocks of a network, e.g.:
+
+        a = CidrAllocator('10.0.0.0/16', ['10.0.0.0/20', '10.0.16.0/24'])
+        a.allocate(24)  # IPv4Network('10.0.17.0/24')
+    '''
+    def __init__(self, cidr, used=()):
+        self.network = ipaddress.ip_network(cidr)
+        # used ranges as integers, [start, end) with no two touching
+        self.starts = []
+        self.ends = []
+        for u in used:
+            self.reserve(u)
+
+    def reserve(self, cidr):
+        '''
+        reserve() marks cidr as in use; it may overlap ranges already reserved
+        '''
+        n = ipaddress.ip_network(cidr)
+        self.reserve_range(int(n.network_address), int(n.network_address) + n.num_addresses)
+
+    def reserve_first(self, count, prefixlen):
+        '''
+        reserve_first() marks the first count blocks of size prefixlen at the
+        start of the network as in use, for --subnet-offset
+        '''
+        base = int(self.network.network_address)
+        self.reserve_range(base, base + count * (1 << (self.network.max_prefixlen - prefixlen)))
+
+    def reserve_range(self, start, end):
+        if start >= end:
+            return
+        # Find every reserved range that overlaps or touches this one and
+        # replace them all with a single range that covers them
+        lo = bisect.bisect_left(self.ends, start)
+        hi = bisect.bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+    def gaps(self):
+        '''
+        gaps() yields the free ranges of the network as [start, end) integers
+        '''
+        start = int(self.network.network_address)
+        stop = start + self.network.num_addresses
+        for used_start, used_end in zip(self.starts, self.ends):
+            if used_start > start:
+                yield start, min(used_start, stop)
+            start = max(start, used_end)
+        if start < stop:
+            yield start, stop
+
+    def allocate(self, prefixlen):
+        '''
+        allocate() reserves and returns the first free block of the network
+        with the given prefix length, or raises ValueError if there isn't one
+        '''
+        size = 1 << (self.network.max_prefixlen - prefixlen)
+        for start, end in self.gaps():
+            # blocks have to start on a multiple of their own size
+            aligned = -(-start // size) * size
+            if aligned + size <= end:
+                block = self.network.__class__((aligned, prefixlen))
+                self.reserve(block)
+                return block
+        raise ValueError('No free /{} left in {}'.format(prefixlen, self.network))
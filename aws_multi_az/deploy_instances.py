@@ -6,6 +6,7 @@ Consult README.md for more information.
 '''
 
 import argparse
+import concurrent.futures
 import ipaddress
 import os
 import sys
@@ -16,12 +17,73 @@ from collections import defaultdict
 import boto3
 import botocore.exceptions
 
+import aws_inventory
+import cidr_allocator
+import disk_cache
+import readiness
+from reporting import report
+
 def comma_list(values):
     '''
     comma_list() is used to represent a type for the --availability-zones argument
     '''
     return values.split(',')
 
+def run_dag(tasks, max_workers=None):
+    '''
+    run_dag() runs the tasks in a dict of name: (function, [dependency names])
+    in a thread pool, starting each one as soon as all of its dependencies
+    have finished. Each function is called with a dict of the results of the
+    tasks finished so far, and the results of all tasks are returned the same
+    way. If any task fails, no new tasks are started and the exception is
+    raised once the running ones finish.
+    '''
+    results = {}
+    waiting = dict(tasks)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            for name, (fn, deps) in list(waiting.items()):
+                if all(d in results for d in deps):
+                    running[executor.submit(fn, dict(results))] = name
+                    del waiting[name]
+            if not running:
+                raise ValueError('Tasks {} can never run'.format(', '.join(waiting)))
+            done, _ = concurrent.futures.wait(running,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    for f in running:
+                        f.cancel()
+                    concurrent.futures.wait(running)
+                    raise future.exception()
+                results[name] = future.result()
+    return results
+
+def get_public_ip():
+    '''
+    get_public_ip() finds the public IP address of this machine, for the
+    default of --public-ip. It's only looked up when it's needed, so that
+    --help and friends don't have to wait on the network.
+    '''
+    return disk_cache.cached('public_ip', 3600, lambda: urllib.request.urlopen('http://icanhazip.com',
+        timeout=1).read().decode('utf-8').strip() + '/32')
+
+def get_default_image_id():
+    '''
+    get_default_image_id() looks up the current Ubuntu 20.04 amd64 AMI in the
+    region from the parameter Canonical publishes in SSM, same as
+    class-instances/create-instances.py, instead of searching all of
+    Canonical's images
+    '''
+    def lookup():
+        ssm = boto3.client('ssm')
+        return ssm.get_parameters(
+            Names=["/aws/service/canonical/ubuntu/server/20.04/stable/current/amd64/hvm/ebs-gp2/ami-id"]
+        )['Parameters'][0]['Value']
+    return disk_cache.cached('ami:' + boto3.session.Session().region_name, 86400, lookup)
+
 parser = argparse.ArgumentParser(description='Deploy multi-AZ resources to AWS')
 parser.add_argument('-k', '--key-name', type=str,
         help='The name of the EC2 keypair you will use to connect to the instances', required=True)
@@ -43,17 +105,26 @@ parser.add_argument('--instance-ami', type=str,
 parser.add_argument('--instance-type', type=str,
         help='The EC2 instance type to use (default %(default)s)', default='m5.2xlarge')
 parser.add_argument('--subnet-offset', type=int,
-        help='Set this to a positive integer if you need to avoid some ' +
-             'IP ranges already allocated to existing subnets', default=1)
+        help='Set this to a positive integer to leave some IP ranges at the ' +
+             'start of the VPC unused (existing subnets are always avoided)', default=1)
 parser.add_argument('--subnet-prefix', type=int,
         help='The CIDR prefix for the new subnets created (default %(default)d)', default=24)
 parser.add_argument('--disk-size', type=int,
         help='Size in GB of root EBS volume (default %(default)d)', default=64)
 parser.add_argument('--public-ip', type=str,
         help='This IP address will have unrestricted TCP and UDP ' +
-             'access to all instances (default %(default)s)',
-        default=urllib.request.urlopen('http://icanhazip.com',
-            timeout=1).read().decode('utf-8').strip() + '/32')
+             'access to all instances (default this machine\'s public IP, from icanhazip.com)')
+parser.add_argument('--ssh-user', type=str,
+        help='The user to log in as to check that instances are ready (default %(default)s)',
+        default='ubuntu')
+parser.add_argument('--identity-file', type=str,
+        help='The private key for --key-name, if ssh doesn\'t find it by itself')
+parser.add_argument('--ready-timeout', type=int,
+        help='Seconds to wait for all instances to be ready (default %(default)d)', default=1200)
+parser.add_argument('--ready-connections', type=int,
+        help='The number of instances to check at the same time (default %(default)d)', default=32)
+parser.add_argument('--no-wait-ready', action='store_true',
+        help='Stop once the instances are "running", without waiting for SSH and cloud-init')
 parser.add_argument('--vpc-cidr', type=str,
         help=argparse.SUPPRESS, default='10.0.0.0/16')
 
@@ -63,12 +134,14 @@ ec2 = boto3.client('ec2')
 
 print('Creating cluster {}'.format(args.cluster_name))
 
-if not any( key['KeyName']==args.key_name for key in ec2.describe_key_pairs()['KeyPairs'] ):
+inventory = aws_inventory.Inventory(ec2)
+
+if not inventory.load('key-pair', Filters=[{'Name':'key-name', 'Values':[args.key_name]}]):
     print('KeyPair "{}" could not be found'.format(args.key_name), file=sys.stderr)
     sys.exit(1)
 
 if args.vpc_id:
-    vpc = [vpc for vpc in ec2.describe_vpcs()['Vpcs'] if vpc['VpcId']==args.vpc_id]
+    vpc = inventory.load('vpc', Filters=[{'Name':'vpc-id', 'Values':[args.vpc_id]}])
     if len(vpc):
         args.vpc_cidr = vpc[0]['CidrBlock']
     else:
@@ -77,7 +150,7 @@ if args.vpc_id:
     vpc_id = args.vpc_id
     print(vpc_id + ' (from command-line option)')
 else:
-    vpc = ec2.describe_vpcs(Filters=[{'Name':'isDefault', 'Values':['true']}])['Vpcs'][0]
+    vpc = inventory.load('vpc', Filters=[{'Name':'isDefault', 'Values':['true']}])[0]
     args.vpc_id = vpc['VpcId']
     args.vpc_cidr = vpc['CidrBlock']
     vpc_id = args.vpc_id
@@ -110,126 +183,172 @@ ec2.describe_availability_zones(ZoneNames=args.availability_zones)
 
 
 
-subnets=[]
-subnet_ranges = list(ipaddress.ip_network(args.vpc_cidr).subnets(new_prefix=args.subnet_prefix))
-for i, az in enumerate(args.availability_zones, start=1):
+# Pick a free CIDR block for each AZ's subnet up front, around whatever
+# subnets already exist in the VPC. --subnet-offset has always left that
+# many blocks (plus one) at the start of the VPC range alone, so it still does.
+allocator = cidr_allocator.CidrAllocator(args.vpc_cidr,
+        [s['CidrBlock'] for s in inventory.load('subnet', Filters=[{'Name':'vpc-id','Values':[vpc_id]}])])
+allocator.reserve_first(args.subnet_offset + 1, args.subnet_prefix)
+try:
+    subnet_cidrs = {az: allocator.allocate(args.subnet_prefix) for az in args.availability_zones}
+except ValueError as error:
+    print(error, file=sys.stderr)
+    sys.exit(1)
+
+def create_subnet(az):
     subnet_template = {
             'AvailabilityZone': az,
-            'CidrBlock': subnet_ranges[args.subnet_offset + i].exploded,
+            'CidrBlock': subnet_cidrs[az].exploded,
             'TagSpecifications':[{'ResourceType': 'subnet', 'Tags': tags, }],
             'VpcId': vpc_id
     }
     try:
         subnet = ec2.create_subnet(**subnet_template)
     except botocore.exceptions.ClientError as error:
+        # Only possible if someone else created a subnet since we looked
         if error.response['Error']['Code'] == 'InvalidSubnet.Conflict':
-            subnets = ec2.describe_subnets(Filters=[{'Name':'vpcId','Values':[vpc_id]}])['Subnets']
             print(error, file=sys.stderr)
-            cidr_blocks = [s['CidrBlock'] for s in subnets]
-            print('These are the existing subnets in VPC {}: {}'.format(
-                args.vpc_id, ', '.join(sorted(cidr_blocks))), file=sys.stderr)
-            # Try to see if all the existing subnets have the same prefix!
-            # If so, we can safely calculate the next address. If not... *shrug* ...?
-            p = None
-            for c in cidr_blocks:
-                n = ipaddress.ip_network(c)
-                if p is None:
-                    p = n.prefixlen
-                elif n.prefixlen != p:
-                    print('Existing subnets have inconsistent prefix, please create a new VPC')
-                    sys.exit(1)
-            print('Try --subnet-offset={}'.format(
-                pow(2,(32-p))*len(subnets) // pow(2,32-args.subnet_prefix) ), file=sys.stderr)
+            print('A subnet was created in VPC {} while deploying, try again'.format(
+                args.vpc_id), file=sys.stderr)
             sys.exit(1)
         else:
             raise error
 
-    print(subnet['Subnet']['SubnetId'])
-    subnets.append(subnet['Subnet']['SubnetId'])
-waiter = ec2.get_waiter('subnet_available')
-waiter.wait(SubnetIds=subnets)
-
-sg = ec2.create_security_group(
-        VpcId = vpc_id,
-        Description = args.cluster_name,
-        GroupName = args.cluster_name,
-        TagSpecifications=[{'ResourceType': 'security-group', 'Tags': tags, }],
-)
-sg_id = sg['GroupId']
-print(sg_id)
-
-sg_ingress_template = {
-        'GroupId': sg_id,
-        'IpPermissions': [
-            {'IpProtocol': '-1',
-                'IpRanges': [{'CidrIp': args.public_ip }],
-                'UserIdGroupPairs': [{'GroupId': sg_id}],
-                },
-            {'FromPort': 22,
-                'IpProtocol': 'tcp',
-                'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
-                'Ipv6Ranges': [{'CidrIpv6': '::/0'}],
-                'PrefixListIds': [],
-                'ToPort': 22,
-                'UserIdGroupPairs': []}
-            ],
-        }
-ec2.authorize_security_group_ingress(**sg_ingress_template)
-
-if not args.instance_ami:
-    img = ec2.describe_images(
-            Owners=[ '099720109477' ],
-            Filters=[
-                {'Name':'name','Values':[
-                    'ubuntu/images/hvm-ssd/ubuntu-focal-20.04-amd64-server-*' ]}
-            ]
-    )['Images']
-    args.instance_ami =\
-    sorted(img, key=lambda i: i['CreationDate'])[-1]['ImageId']
- 
-instance_template = {
-        'InstanceType': args.instance_type,
-        'KeyName': args.key_name ,
-        'ImageId': args.instance_ami,
-        'TagSpecifications': [{'ResourceType': 'instance', 'Tags': tags }],
-        'BlockDeviceMappings': [{
-            'DeviceName': '/dev/sda1',
-            'Ebs': {
-                'DeleteOnTermination': True,
-                #'SnapshotId': 'snap-09d3a0caf8c20b475',
-                'VolumeSize': args.disk_size,
-                'VolumeType': 'gp2'
-            }}],
-        'NetworkInterfaces': [{
-            'Groups': [sg_id],
-            'AssociatePublicIpAddress': True,
-            'DeleteOnTermination': True,
-            'DeviceIndex': 0,
-            'SubnetId': None,
-            'NetworkCardIndex': 0
-        }],
-        'MinCount': args.instances_per_az,
-        'MaxCount': args.instances_per_az
-    }
+    subnet_id = subnet['Subnet']['SubnetId']
+    report(subnet_id)
+    waiter = ec2.get_waiter('subnet_available')
+    waiter.wait(SubnetIds=[subnet_id])
+    return subnet_id
 
-instances=[]
-for subnet in subnets:
-    instance_template['NetworkInterfaces'][0]['SubnetId'] = subnet
+def create_security_group(results):
+    if not args.public_ip:
+        args.public_ip = get_public_ip()
+        report('Using public IP {}'.format(args.public_ip))
+    sg = ec2.create_security_group(
+            VpcId = vpc_id,
+            Description = args.cluster_name,
+            GroupName = args.cluster_name,
+            TagSpecifications=[{'ResourceType': 'security-group', 'Tags': tags, }],
+    )
+    sg_id = sg['GroupId']
+    report(sg_id)
+
+    sg_ingress_template = {
+            'GroupId': sg_id,
+            'IpPermissions': [
+                {'IpProtocol': '-1',
+                    'IpRanges': [{'CidrIp': args.public_ip }],
+                    'UserIdGroupPairs': [{'GroupId': sg_id}],
+                    },
+                {'FromPort': 22,
+                    'IpProtocol': 'tcp',
+                    'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+                    'Ipv6Ranges': [{'CidrIpv6': '::/0'}],
+                    'PrefixListIds': [],
+                    'ToPort': 22,
+                    'UserIdGroupPairs': []}
+                ],
+            }
+    ec2.authorize_security_group_ingress(**sg_ingress_template)
+    return sg_id
+
+def find_ami(results):
+    if args.instance_ami:
+        return args.instance_ami
+    return get_default_image_id()
+
+def launch_instances(az, results):
+    instance_template = {
+            'InstanceType': args.instance_type,
+            'KeyName': args.key_name ,
+            'ImageId': results['ami'],
+            'TagSpecifications': [{'ResourceType': 'instance', 'Tags': tags }],
+            'BlockDeviceMappings': [{
+                'DeviceName': '/dev/sda1',
+                'Ebs': {
+                    'DeleteOnTermination': True,
+                    #'SnapshotId': 'snap-09d3a0caf8c20b475',
+                    'VolumeSize': args.disk_size,
+                    'VolumeType': 'gp2'
+                }}],
+            'NetworkInterfaces': [{
+                'Groups': [results['sg']],
+                'AssociatePublicIpAddress': True,
+                'DeleteOnTermination': True,
+                'DeviceIndex': 0,
+                'SubnetId': results['subnet:' + az],
+                'NetworkCardIndex': 0
+            }],
+            'MinCount': args.instances_per_az,
+            'MaxCount': args.instances_per_az
+        }
     inst = ec2.run_instances( **instance_template )
-    for i in inst['Instances']:
-        print(i['InstanceId'])
-        instances.append(i['InstanceId'])
+    instance_ids = [i['InstanceId'] for i in inst['Instances']]
+    report('\n'.join(instance_ids))
+    return instance_ids
+
+# The security group and AMI lookup don't depend on anything, and each AZ
+# goes subnet -> run_instances on its own, so the whole deployment takes
+# about as long as the slowest AZ instead of the sum of all of them.
+tasks = {
+        'sg': (create_security_group, []),
+        'ami': (find_ami, []),
+}
+for az in args.availability_zones:
+    tasks['subnet:' + az] = (lambda results, az=az: create_subnet(az), [])
+    tasks['instances:' + az] = (lambda results, az=az: launch_instances(az, results),
+            ['sg', 'ami', 'subnet:' + az])
+results = run_dag(tasks)
+args.instance_ami = results['ami']
+
+instances = [i for az in args.availability_zones for i in results['instances:' + az]]
+
+# Rather than block on a waiter for the whole batch, poll the instances
+# that aren't "running" yet and report each one as soon as it gets there
 print('Waiting for all instances to be "running"...')
-waiter = ec2.get_waiter('instance_running')
-waiter.wait(InstanceIds=instances)
+running = {}
+while len(running) < len(instances):
+    pending = [i for i in instances if i not in running]
+    try:
+        instance_info = ec2.describe_instances(InstanceIds=pending)
+    except botocore.exceptions.ClientError as error:
+        # Instances that were just launched can take a moment to show up
+        if error.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+            raise error
+        instance_info = {'Reservations': []}
+    for r in instance_info['Reservations']:
+        for i in r['Instances']:
+            state = i['State']['Name']
+            if state == 'running':
+                running[i['InstanceId']] = i
+                print('running: {} ({}, {})'.format(
+                    i['InstanceId'], i['Placement']['AvailabilityZone'],
+                    i.get('PublicIpAddress')))
+            elif state != 'pending':
+                print('Instance {} is "{}"'.format(i['InstanceId'], state), file=sys.stderr)
+                sys.exit(1)
+    if len(running) < len(instances):
+        time.sleep(5)
+
+# "running" only means the instance has booted, so wait until we can log
+# in and cloud-init has finished before calling the cluster deployed
+not_ready = []
+if not args.no_wait_ready:
+    print('Waiting for all instances to be ready...')
+    ready = readiness.wait_ready([{
+        'id': i['InstanceId'],
+        'host': i['PublicIpAddress'],
+        'launched': i['LaunchTime'].timestamp(),
+        'identity_file': args.identity_file,
+        } for i in running.values()], args.ssh_user,
+        max_connections=args.ready_connections, timeout=args.ready_timeout, report=report)
+    not_ready = [i for i in running if i not in ready]
 
 print('Instances of cluster "{}" deployed!'.format(args.cluster_name))
 
-instance_info = ec2.describe_instances(InstanceIds=instances)
 instance_details = defaultdict(list)
-for r in instance_info['Reservations']:
-    for i in r['Instances']:
-        instance_details[i['Placement']['AvailabilityZone']].append(i)
+for i in running.values():
+    instance_details[i['Placement']['AvailabilityZone']].append(i)
 for k in sorted(instance_details.keys()):
     for i, instance in enumerate(
             sorted(instance_details[k],
@@ -242,3 +361,6 @@ for k in sorted(instance_details.keys()):
 
 print('export CLUSTER_NAME={}'.format(args.cluster_name))
 print()
+
+if not_ready:
+    sys.exit(1)
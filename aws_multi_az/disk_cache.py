@@ -0,0 +1,43 @@
+'''
+disk_cache.py keeps values that are slow to look up but rarely change (this
+machine's public IP, the current AMI, instance type specs) in a JSON file in
+the user's cache directory, each with the time it was looked up, so that
+the scripts in aws_multi_az don't have to look them up on every run.
+'''
+
+import json
+import os
+import threading
+import time
+
+cache_file = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'tiup-multi-az', 'defaults.json')
+
+cache_lock = threading.Lock()
+
+def read_cache():
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def cached(key, ttl, lookup):
+    '''
+    cached() returns the value saved under key in cache_file if it is less
+    than ttl seconds old, and otherwise calls lookup() and saves its result
+    '''
+    with cache_lock:
+        cache = read_cache()
+    if key in cache and time.time() - cache[key][1] < ttl:
+        return cache[key][0]
+    value = lookup()
+    with cache_lock:
+        cache = read_cache()
+        cache[key] = [value, time.time()]
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp = '{}.{}'.format(cache_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cache, f, indent=1)
+        os.replace(tmp, cache_file)
+    return value
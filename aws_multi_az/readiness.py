@@ -0,0 +1,139 @@
+'''
+readiness.py waits for freshly launched instances to actually be usable,
+used by deploy_instances.py and class-instances/create-instances.py.
+
+An instance being "running" only means it has booted; cloud-init goes on
+installing packages and running user_data commands for minutes after
+that. An instance counts as ready once SSH accepts a login and cloud-init
+has written its boot-finished marker. All of the instances are probed at
+the same time from one event loop, with a limit on how many probes are in
+flight, and the time each one took to become ready (from its launch) is
+reported so that AMIs and instance types can be compared.
+'''
+
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BOOT_FINISHED = '/var/lib/cloud/instance/boot-finished'
+
+SSH_OPTIONS = [
+        '-o', 'BatchMode=yes',
+        '-o', 'ConnectTimeout=10',
+        # The instances are new, so their host keys can't be known yet, and
+        # there's no point in remembering keys for IPs that will be reused
+        '-o', 'StrictHostKeyChecking=no',
+        '-o', 'UserKnownHostsFile=/dev/null',
+        '-o', 'LogLevel=ERROR',
+]
+
+class ProbeError(Exception):
+    '''
+    ProbeError means an instance can never become ready, e.g. because the
+    key doesn't let us log in, so there's no point in probing it again
+    '''
+
+async def ssh_banner(host, timeout):
+    '''
+    ssh_banner() returns True if sshd answers on host. It's a lot cheaper
+    than starting ssh, so it's used to wait out the early part of the boot.
+    '''
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, 22), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        banner = await asyncio.wait_for(reader.readline(), timeout)
+    except (OSError, asyncio.TimeoutError):
+        banner = b''
+    writer.close()
+    return banner.startswith(b'SSH-')
+
+async def boot_finished(host, user, identity_file, timeout):
+    '''
+    boot_finished() logs in to host and returns True if cloud-init is done
+    '''
+    command = ['ssh'] + SSH_OPTIONS
+    if identity_file:
+        command += ['-i', identity_file, '-o', 'IdentitiesOnly=yes']
+    command += ['{}@{}'.format(user, host), 'test', '-e', BOOT_FINISHED]
+    proc = await asyncio.create_subprocess_exec(*command,
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE)
+    try:
+        _, err = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return False
+    # ssh exits with 255 for its own errors and with the exit status of
+    # the command otherwise
+    if proc.returncode == 255 and b'Permission denied' in err:
+        raise ProbeError(err.decode(errors='replace').strip())
+    return proc.returncode == 0
+
+async def probe(target, user, connections, deadline, interval, report):
+    '''
+    probe() checks one instance every interval seconds until it's ready or
+    deadline passes, and returns its time to ready (or None)
+    '''
+    reachable = False
+    while time.time() < deadline:
+        async with connections:
+            if not reachable and await ssh_banner(target['host'], interval):
+                reachable = True
+                report('ssh: {} ({}s)'.format(target['id'],
+                    round(time.time() - target['launched'])))
+            if reachable and await boot_finished(target['host'], user,
+                    target.get('identity_file'), 3 * interval):
+                ready = time.time() - target['launched']
+                report('ready: {} ({}s)'.format(target['id'], round(ready)))
+                return ready
+        await asyncio.sleep(interval)
+    return None
+
+async def probe_all(targets, user, max_connections, timeout, interval, report):
+    connections = asyncio.Semaphore(max_connections)
+    deadline = time.time() + timeout
+    results = await asyncio.gather(
+            *[probe(t, user, connections, deadline, interval, report) for t in targets],
+            return_exceptions=True)
+    ready = {}
+    for target, result in zip(targets, results):
+        if isinstance(result, ProbeError):
+            print('{}: {}'.format(target['id'], result), file=sys.stderr)
+        elif isinstance(result, BaseException):
+            raise result
+        elif result is not None:
+            ready[target['id']] = result
+    return ready
+
+def wait_ready(targets, user, max_connections=32, timeout=1800, interval=5, report=print):
+    '''
+    wait_ready() probes all of targets, a list of dicts with 'id', 'host'
+    (the address to connect to), 'launched' (a timestamp), and optionally
+    'key' (private key material) or 'identity_file', until each one is
+    ready or timeout seconds have passed. It returns a dict of ID: seconds
+    from launch to ready for the instances that became ready.
+    '''
+    with tempfile.TemporaryDirectory() as keys:
+        targets = [dict(t) for t in targets]
+        for n, t in enumerate(targets):
+            if t.get('key'):
+                t['identity_file'] = os.path.join(keys, str(n))
+                with open(os.open(t['identity_file'], os.O_WRONLY | os.O_CREAT, 0o600), 'w') as f:
+                    f.write(t['key'])
+        ready = asyncio.run(probe_all(targets, user, max_connections, timeout, interval, report))
+
+    not_ready = [t['id'] for t in targets if t['id'] not in ready]
+    if ready:
+        times = sorted(ready.values())
+        report('{} of {} instances ready, time to ready min {}s, median {}s, max {}s'.format(
+            len(ready), len(targets), round(times[0]), round(statistics.median(times)),
+            round(times[-1])))
+    if not_ready:
+        print('Not ready: {}'.format(', '.join(not_ready)), file=sys.stderr)
+    return ready
@@ -0,0 +1,16 @@
+'''
+reporting.py has report(), which is print() for the scripts in aws_multi_az
+that print from worker threads.
+'''
+
+import threading
+
+output_lock = threading.Lock()
+
+def report(*args, **kwargs):
+    '''
+    report() is print() for use from the worker threads, so that lines
+    printed by different threads don't get mixed together
+    '''
+    with output_lock:
+        print(*args, **kwargs, flush=True)
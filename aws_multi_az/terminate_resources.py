@@ -1,39 +1,168 @@
 #!/usr/bin/env python3
+'''
+terminate_resources.py deletes everything that deploy_instances.py (or
+class-instances/create-instances.py) created: instances, subnets, security
+groups, and key pairs that have a given tag.
 
+Each resource is deleted as soon as the instances that depend on it are
+gone, and several clusters or courses can be torn down at the same time.
+'''
+
+import argparse
+import concurrent.futures
 import os
 import sys
+import time
 
 import boto3
-ec2 = boto3.client('ec2')
+import botocore.config
+import botocore.exceptions
 
-cluster_name = os.getenv('CLUSTER_NAME')
-if not cluster_name:
-    print('CLUSTER_NAME not defined in environment')
-    sys.exit(1)
+import aws_inventory
+from reporting import report
+
+parser = argparse.ArgumentParser(description='Delete all resources of one or more clusters')
+parser.add_argument('names', nargs='*',
+        help='The values of the tag that identify the resources to delete ' +
+             '(default $CLUSTER_NAME, with the default --tag only)')
+parser.add_argument('--tag', type=str, default='Name',
+        help='The tag that identifies the resources (default %(default)s, ' +
+             'use CourseId for create-instances.py courses)')
+parser.add_argument('--dry-run', action='store_true',
+        help='Only print what would be deleted')
+parser.add_argument('--workers', type=int, default=32,
+        help='The number of resources to delete at the same time (default %(default)d)')
+parser.add_argument('--timeout', type=int, default=900,
+        help='Seconds to keep retrying a resource that is still in use (default %(default)d)')
+parser.add_argument('--terminate-timeout', type=int, default=900,
+        help='Seconds to wait for the instances to be terminated (default %(default)d)')
+
+args = parser.parse_args()
+
+if not args.names:
+    # $CLUSTER_NAME is a cluster's Name, so it mustn't be matched against
+    # any other tag
+    if args.tag != 'Name':
+        print('Give the {} values of the resources to delete'.format(args.tag))
+        sys.exit(1)
+    if not os.getenv('CLUSTER_NAME'):
+        print('CLUSTER_NAME not defined in environment')
+        sys.exit(1)
+    args.names = [os.getenv('CLUSTER_NAME')]
+
+ec2 = boto3.client('ec2', config=botocore.config.Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10}))
 
-print('Deleting resources for CLUSTER_NAME={}'.format(cluster_name))
+# Everything for all of the names is found up front, with one (paginated)
+# call per resource type, and each teardown picks its own out of that
+inventory = aws_inventory.Inventory(ec2)
+name_filter = [aws_inventory.tag_filter(args.tag, *args.names)]
+for resource_type in ['instance', 'subnet', 'security-group', 'key-pair']:
+    inventory.load(resource_type, Filters=name_filter)
 
-cluster_name_filter=[ {'Name':'tag:Name', 'Values':[cluster_name]} ]
+def wait_terminated(instance_ids):
+    '''
+    wait_terminated() polls until all of instance_ids are terminated, or
+    raises TimeoutError after --terminate-timeout seconds. It's used instead
+    of a waiter so that each resource only waits on the instances that
+    actually use it.
+    '''
+    remaining = set(instance_ids)
+    deadline = time.time() + args.terminate_timeout
+    while remaining:
+        if time.time() > deadline:
+            raise TimeoutError('{} not terminated after {} seconds'.format(
+                ', '.join(sorted(remaining)), args.terminate_timeout))
+        for page in ec2.get_paginator('describe_instances').paginate(
+                InstanceIds=sorted(remaining)):
+            for r in page['Reservations']:
+                for i in r['Instances']:
+                    if i['State']['Name'] == 'terminated':
+                        remaining.discard(i['InstanceId'])
+        if remaining:
+            time.sleep(5)
 
-instances = ec2.describe_instances(
-        Filters=cluster_name_filter
-            # [{'Name':'instance-state-name', 'Values':['running']}]
-            )
-instance_ids=[]
-for r in instances['Reservations']:
-    for i in r['Instances']:
-        instance_ids.append(i['InstanceId'])
-if instance_ids:
-    print(ec2.terminate_instances( InstanceIds=instance_ids ))
+def delete(description, fn, **kwargs):
+    '''
+    delete() calls fn(**kwargs), retrying with exponential backoff for as
+    long as AWS says the resource is still in use (network interfaces
+    can take a while to detach after their instance is terminated)
+    '''
+    if args.dry_run:
+        report('Would delete {}'.format(description))
+        return
+    delay = 2
+    deadline = time.time() + args.timeout
+    while True:
+        try:
+            fn(**kwargs)
+            report('Deleted {}'.format(description))
+            return
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] != 'DependencyViolation' or time.time() > deadline:
+                raise error
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
 
-    print('Waiting for all instances to be "terminated"...')
-    waiter = ec2.get_waiter('instance_terminated')
-    waiter.wait(InstanceIds=instance_ids)
+def teardown(executor, name):
+    '''
+    teardown() picks every resource tagged with name out of the inventory
+    and schedules its deletion in executor, returning the futures
+    '''
+    resources = lambda resource_type: inventory.find(resource_type, **{args.tag: name})
+    report('Deleting resources for {}={}'.format(args.tag, name))
 
-subnets = ec2.describe_subnets(Filters=cluster_name_filter)
-for s in subnets['Subnets']:
-    print(ec2.delete_subnet(SubnetId=s['SubnetId']))
+    instances = [i for i in resources('instance') if i['State']['Name'] != 'terminated']
+    instance_ids = [i['InstanceId'] for i in instances]
+    if instance_ids:
+        if args.dry_run:
+            report('Would terminate {}'.format(', '.join(instance_ids)))
+        else:
+            ec2.terminate_instances(InstanceIds=instance_ids)
+            report('Terminating {}'.format(', '.join(instance_ids)))
 
-security_groups = ec2.describe_security_groups(Filters=cluster_name_filter)
-for sg in security_groups['SecurityGroups']:
-    print(ec2.delete_security_group(GroupId=sg['GroupId']))
+    def delete_after(instance_ids, description, fn, **kwargs):
+        if instance_ids and not args.dry_run:
+            wait_terminated(instance_ids)
+        delete(description, fn, **kwargs)
+
+    futures = []
+    for s in resources('subnet'):
+        users = [i['InstanceId'] for i in instances if i.get('SubnetId') == s['SubnetId']]
+        futures.append(executor.submit(delete_after, users, 'subnet ' + s['SubnetId'],
+            ec2.delete_subnet, SubnetId=s['SubnetId']))
+    for sg in resources('security-group'):
+        users = [i['InstanceId'] for i in instances
+                if any(g['GroupId'] == sg['GroupId'] for g in i.get('SecurityGroups', []))]
+        futures.append(executor.submit(delete_after, users, 'security group ' + sg['GroupId'],
+            ec2.delete_security_group, GroupId=sg['GroupId']))
+    # Key pairs aren't used by anything once an instance is launched
+    for k in resources('key-pair'):
+        futures.append(executor.submit(delete, 'key pair ' + k['KeyName'],
+            ec2.delete_key_pair, KeyName=k['KeyName']))
+    return futures
+
+def try_teardown(executor, name):
+    '''
+    try_teardown() is teardown(), except that if it fails the error is
+    reported and None is returned, so that the other names are still torn
+    down
+    '''
+    try:
+        return teardown(executor, name)
+    except botocore.exceptions.ClientError as error:
+        report('{}={}: {}'.format(args.tag, name, error), file=sys.stderr)
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+    scheduled = list(executor.map(lambda name: try_teardown(executor, name), args.names))
+    failed = scheduled.count(None)
+    futures = [f for fs in scheduled if fs is not None for f in fs]
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            future.result()
+        except (botocore.exceptions.ClientError, TimeoutError) as error:
+            report(error, file=sys.stderr)
+            failed += 1
+
+if failed:
+    sys.exit(1)
@@ -2,6 +2,8 @@
 psmysql () { pids=($(pgrep -x mysqld)) && ps -o pid,user,rss,%cpu,command -p "${pids[@]}" | perl -pe 's#(^\s*\d+)(.*)#'"$(tput setaf 6; tput bold)"'\1'"$(tput sgr0; tput setaf 7)"'\2'"$(tput sgr0; tput setaf 7)"'#;s#(^.*?/)(\w+-\d\d?\.\d?\.\d\d?)(-.*$)#\1'"$(tput setaf 2; tput bold)"'\2'"$(tput sgr0; tput setaf 7)"'\3'"$(tput sgr0)"'#g; END{print "'"$(tput sgr0)"'";}'; }
 
 my_status_diff() { egrep -h "$1" "${@:2}" | deltas -h | column -t; }
+# live per-second rates of the top movers: my_status_live [<regex> [<interval> [<top n>]]]
+my_status_live() { while mysql -BNe 'show global status'; do sleep "${2:-1}"; done | egrep --line-buffered "${1:-.}" | deltas -r -Z -n -t "${3:-20}"; }
 
 my_cnf() { 
     local debug=${debug:-0}
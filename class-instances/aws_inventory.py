@@ -0,0 +1 @@
+../aws_multi_az/aws_inventory.py
\ No newline at end of file
@@ -0,0 +1 @@
+../aws_multi_az/cidr_allocator.py
\ No newline at end of file
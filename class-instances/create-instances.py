@@ -1,17 +1,27 @@
 #!/usr/bin/env python3
 
 import argparse
-import ipaddress
+import concurrent.futures
+import copy
+import hashlib
 import json
+import multiprocessing
 import os
 import secrets
 import sys
+import threading
 import time
 
 import boto3
+import botocore.config
+import botocore.exceptions
 import passlib.hash
 import yaml
 
+import aws_inventory
+import cidr_allocator
+import readiness
+
 # If no explicit instance AMI is given, we look up the most-recent release of
 # Ubuntu 20.20 LTS for amd64. Using this most-recent AMI means that we don't
 # have to pay attention to their periodic releases or worry too much about 
@@ -47,7 +57,21 @@ parser.add_argument('--instance-type', type=str,
 parser.add_argument('--disk-size', type=int,
         help='Size in GB of root EBS volume (default %(default)d)', default=64)
 parser.add_argument('--subnet-offset', type=int,
-        help='Subnet offset (default %(default)d)', default=0)
+        help='The number of /22 blocks at the start of the VPC to leave unused ' +
+             '(default %(default)d)', default=0)
+parser.add_argument('--workers', type=int,
+        help='The number of seats to provision at the same time (default %(default)d)', default=16)
+parser.add_argument('--ready-timeout', type=int,
+        help='Seconds to wait for all instances to be ready (default %(default)d)', default=1800)
+parser.add_argument('--ready-connections', type=int,
+        help='The number of instances to check at the same time (default %(default)d)', default=64)
+parser.add_argument('--no-wait-ready', action='store_true',
+        help='Stop once the instances are "running", without waiting for SSH and cloud-init')
+parser.add_argument('--journal', type=str,
+        help='File that records every resource as it is created (default <course-id>.journal)')
+parser.add_argument('--resume', action='store_true',
+        help='Pick up a failed run of the same --course-id from its journal, ' +
+             'reusing everything that was already created')
 
 class Seat(dict):
     def __init__(self, key, password, instances):
@@ -58,8 +82,74 @@ class Seat(dict):
                 addresses=[]
         )
 
+class Journal:
+    '''
+    Journal is an append-only record of each resource as soon as it is
+    created, one JSON object per line, so that a run that dies partway
+    through can be finished with --resume instead of leaving everything it
+    created orphaned. It holds key material and passwords, so only the
+    owner can read it.
+    '''
+    def __init__(self, path, resume):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {}
+        self.seats = {}
+        if resume:
+            with open(path) as f:
+                for line in f:
+                    self.update(json.loads(line))
+        self.f = os.fdopen(os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), 'a')
+
+    def update(self, entry):
+        if 'seat' in entry:
+            self.seats.setdefault(entry['seat'], {}).update(entry)
+        else:
+            self.state.update(entry)
+
+    def record(self, **entry):
+        with self.lock:
+            self.update(entry)
+            print(json.dumps(entry), file=self.f, flush=True)
+            os.fsync(self.f.fileno())
+
+# sha512_crypt is deliberately slow (thousands of rounds), so passwords
+# are generated and hashed in a pool of processes instead of inline with
+# the AWS calls for each seat
+def make_password(seat):
+    password = secrets.token_urlsafe(18)
+    return password, passlib.hash.sha512_crypt.hash(password)
+
 args = parser.parse_args()
 
+if not args.journal:
+    args.journal = '{}.journal'.format(args.course_id)
+if args.resume and not os.path.exists(args.journal):
+    print('No journal "{}" to resume from'.format(args.journal), file=sys.stderr)
+    sys.exit(1)
+# Appending a new run to an old run's journal would mix their resources up
+# the next time it's resumed
+if not args.resume and os.path.exists(args.journal):
+    print('Journal "{}" already exists; use --resume to finish that run, '.format(args.journal) +
+            'or delete it along with the course', file=sys.stderr)
+    sys.exit(1)
+journal = Journal(args.journal, args.resume)
+print('Recording created resources in {}'.format(args.journal), file=sys.stderr)
+# The instances' ClientTokens are made from this, so that they're the same
+# when resuming this run but not for a later run with the same --course-id
+if 'run' not in journal.state:
+    journal.record(run=secrets.token_hex(16))
+
+# Start hashing every seat's password right away, so that it happens while
+# we're waiting on the network to create the subnet, security group, and
+# key pairs. This script isn't importable, so the pool has to fork rather
+# than spawn (which would re-run the whole script in every process), and
+# it has to fork before anything else starts any threads.
+hasher = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context('fork'))
+passwords = [hasher.submit(make_password, seat) if 'password' not in journal.seats.get(seat, {})
+        else None for seat in range(args.num_seats)]
+
 # This user_data structure is in a strange place at the top of this file
 # because it might be useful to modify this or make it a parameter or
 # something in case we want to change the packages installed on the host
@@ -106,64 +196,67 @@ subnet_template = {
         }
 
 # boto3.set_stream_logger('')
-ec2 = boto3.client('ec2')
+# Seats are provisioned in parallel, which makes it easy to run into EC2's
+# API rate limits for a big class. The "adaptive" retry mode backs off
+# exponentially when throttled and also slows down the client side so
+# that all of the threads sharing this client stop hammering the API.
+ec2 = boto3.client('ec2', config=botocore.config.Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10}))
 
 print('Using AMI {}'.format(args.instance_ami), file=sys.stderr)
 
-# For now, get the list of existing VPCs and loop through them until we find the
-# VPC given on the command line.
-# TODO: Yeah, it should just filter server-side.
-vpc = None
-for v in ec2.describe_vpcs()['Vpcs']:
-    if v['VpcId']==args.vpc_id:
-        vpc=v
-if vpc:
-    vpc_cidr = vpc['CidrBlock']
-else:
-    print('VPC "{}" could not be found'.format(args.vpc_id), file=sys.stderr)
-
-# This is some weird "special sauce" to try to find an unused CIDR range that
-# can be used for a new subnet. If it's possible to find one, we will simply
-# create a subnet and put all instances in it. If the existing subnets are too
-# complex, especially if there are existing subnets with different prefix sizes,
-# such as "/22" and "/24" together in the same VPC, the math is too difficult,
-# and it's best to create a new VPC.
-subnet_prefix = 22
-subnet_ranges = list(ipaddress.ip_network(vpc_cidr).subnets(new_prefix=subnet_prefix))
-if args.subnet_offset == 0:
-    subnets = ec2.describe_subnets(Filters=[{'Name':'vpcId','Values':[args.vpc_id]}])['Subnets']
+inventory = aws_inventory.Inventory(ec2)
+vpc_filter = [{'Name':'vpc-id','Values':[args.vpc_id]}]
+
+# A resource that was created just before the last run died won't be in
+# the journal, but it will be tagged, so look for it before creating another
+if args.resume and 'subnet' not in journal.state:
+    inventory.load('subnet', Filters=vpc_filter)
+    for s in inventory.find('subnet', CourseId=args.course_id):
+        journal.record(subnet=s['SubnetId'])
+if args.resume and 'security_group' not in journal.state:
+    for sg in inventory.load('security-group', Filters=vpc_filter):
+        if sg['GroupName'] == args.course_id:
+            journal.record(security_group=sg['GroupId'])
+
+if 'subnet' not in journal.state:
+    vpc = inventory.load('vpc', Filters=vpc_filter)
+    if vpc:
+        vpc_cidr = vpc[0]['CidrBlock']
+    else:
+        print('VPC "{}" could not be found'.format(args.vpc_id), file=sys.stderr)
+        sys.exit(1)
+
+    # Find the first free /22 in the VPC, around whatever subnets are
+    # already there, no matter what size they are
+    subnet_prefix = 22
+    subnets = inventory.load('subnet', Filters=vpc_filter)
     if subnets:
-        cidr_blocks = [s['CidrBlock'] for s in subnets]
         print('These are the existing subnets in VPC {}: {}'.format(
-            args.vpc_id, ', '.join(sorted(cidr_blocks))), file=sys.stderr)
-        # Try to see if all the existing subnets have the same prefix!
-        # If so, we can safely calculate the next address. If not... *shrug* ...?
-        p = None
-        for c in cidr_blocks:
-            n = ipaddress.ip_network(c)
-            if p is None:
-                p = n.prefixlen
-            elif n.prefixlen != p:
-                print('Existing subnets have inconsistent prefix, please create a new VPC',
-                        file=sys.stderr)
-                sys.exit(1)
-
-        # This formula identifies the next available CIDR range after accounting for
-        # existing subnets.
-        args.subnet_offset = ( pow(2,(32-p))*len(subnets) // pow(2,32-subnet_prefix) )
-print('Trying subnet_offset={}'.format(args.subnet_offset), file=sys.stderr)
-
-subnet_template['CidrBlock'] = subnet_ranges[args.subnet_offset].exploded
-subnet = ec2.create_subnet(**subnet_template)['Subnet']
-print(subnet['SubnetId'], file=sys.stderr)
-
-sg = ec2.create_security_group(
-        VpcId = args.vpc_id,
-        Description = args.course_id,
-        GroupName = args.course_id,
-        TagSpecifications=[{'ResourceType': 'security-group', 'Tags': tags, }],
-)
-sg_id = sg['GroupId']
+            args.vpc_id, ', '.join(sorted(s['CidrBlock'] for s in subnets))), file=sys.stderr)
+    allocator = cidr_allocator.CidrAllocator(vpc_cidr, [s['CidrBlock'] for s in subnets])
+    allocator.reserve_first(args.subnet_offset, subnet_prefix)
+    try:
+        subnet_template['CidrBlock'] = allocator.allocate(subnet_prefix).exploded
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+    print('Using {}'.format(subnet_template['CidrBlock']), file=sys.stderr)
+
+    subnet_id = ec2.create_subnet(**subnet_template)['Subnet']['SubnetId']
+    journal.record(subnet=subnet_id)
+subnet_id = journal.state['subnet']
+print(subnet_id, file=sys.stderr)
+
+if 'security_group' not in journal.state:
+    sg = ec2.create_security_group(
+            VpcId = args.vpc_id,
+            Description = args.course_id,
+            GroupName = args.course_id,
+            TagSpecifications=[{'ResourceType': 'security-group', 'Tags': tags, }],
+    )
+    journal.record(security_group=sg['GroupId'])
+sg_id = journal.state['security_group']
 print(sg_id, file=sys.stderr)
 
 sg_ingress_template = {
@@ -181,7 +274,9 @@ sg_ingress_template = {
                 'UserIdGroupPairs': []}
             ],
         }
-ec2.authorize_security_group_ingress(**sg_ingress_template)
+if 'security_group_ingress' not in journal.state:
+    ec2.authorize_security_group_ingress(**sg_ingress_template)
+    journal.record(security_group_ingress=True)
 
 instance_template = {
         'InstanceType': args.instance_type,
@@ -199,35 +294,78 @@ instance_template = {
                 'AssociatePublicIpAddress': True,
                 'DeleteOnTermination': True,
                 'DeviceIndex': 0,
-                'SubnetId': subnet['SubnetId'],
+                'SubnetId': subnet_id,
                 'NetworkCardIndex': 0
                 }],
             'MinCount': args.instances_per_seat,
             'MaxCount': args.instances_per_seat
             }
 
-seats = []
-for seat in range(args.num_seats):
-    password = secrets.token_urlsafe(18)
-
-    user_data['system_info']['default_user']['passwd'] = \
-        passlib.hash.sha512_crypt.hash(password)
-
-    key = ec2.create_key_pair(
-            KeyName='{}-{}'.format(args.course_id, seat),
-            TagSpecifications=[{'ResourceType': 'key-pair', 'Tags': tags, }],
-    )
-    user_data['write_files'][0]={
-            'path': '/root/.ssh/id_rsa',
-            'permissions': '0600',
-            'content': key['KeyMaterial']
-            }
-    instances = ec2.run_instances(
-            KeyName = key['KeyName'],
-            UserData = '#cloud-config\n' + yaml.dump(user_data),
-            **instance_template
-            )
-    seats.append(Seat(key,password,instances))
+def create_key_pair(seat):
+    key_name = '{}-{}'.format(args.course_id, seat)
+    try:
+        return ec2.create_key_pair(
+                KeyName=key_name,
+                TagSpecifications=[{'ResourceType': 'key-pair', 'Tags': tags, }],
+        )
+    except botocore.exceptions.ClientError as error:
+        # When resuming, a key pair that exists but isn't in the journal was
+        # created just before the last run died. Nothing can have used it
+        # yet (instances are only launched once the key is journaled), and
+        # its private key is gone, so just replace it.
+        if not args.resume or error.response['Error']['Code'] != 'InvalidKeyPair.Duplicate':
+            raise error
+        ec2.delete_key_pair(KeyName=key_name)
+        return create_key_pair(seat)
+
+# Each seat gets its own key pair and its own copy of user_data with that
+# key and a hashed password in it. Seats don't depend on each other, so
+# they're provisioned by a pool of threads; executor.map() keeps them in
+# seat order so the output is the same as doing them one at a time.
+#
+# The key, password, and instances are journaled as soon as they exist.
+# run_instances gets a ClientToken unique to the run and seat, so if
+# the last run died after launching a seat's instances but before they
+# were journaled, resuming gets back the same instances instead of
+# launching more. That only works if the request is identical, which is
+# why the password hash (salted differently every time) is journaled too.
+def provision_seat(seat):
+    journaled = journal.seats.get(seat, {})
+    if 'key' not in journaled:
+        key = create_key_pair(seat)
+        password, password_hash = passwords[seat].result()
+        journal.record(seat=seat,
+                key={'KeyName': key['KeyName'], 'KeyMaterial': key['KeyMaterial']},
+                password=password, password_hash=password_hash)
+        journaled = journal.seats[seat]
+    key = journaled['key']
+    password = journaled['password']
+
+    if 'instances' not in journaled:
+        seat_user_data = copy.deepcopy(user_data)
+        seat_user_data['system_info']['default_user']['passwd'] = journaled['password_hash']
+        seat_user_data['write_files'][0]={
+                'path': '/root/.ssh/id_rsa',
+                'permissions': '0600',
+                'content': key['KeyMaterial']
+                }
+        instances = ec2.run_instances(
+                KeyName = key['KeyName'],
+                UserData = '#cloud-config\n' + yaml.dump(seat_user_data),
+                ClientToken = hashlib.sha1('{}-{}-{}'.format(
+                    args.course_id, journal.state['run'], seat).encode()).hexdigest(),
+                **instance_template
+                )
+        journal.record(seat=seat,
+                instances=[i['InstanceId'] for i in instances['Instances']])
+        print('Seat {}: {} {}'.format(seat, key['KeyName'],
+            ', '.join(journal.seats[seat]['instances'])), file=sys.stderr)
+    instances = {'Instances': [{'InstanceId': i} for i in journal.seats[seat]['instances']]}
+    return Seat(key,password,instances)
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+    seats = list(executor.map(provision_seat, range(args.num_seats)))
+hasher.shutdown()
 
 # run_instances can only give you the instance ID and private IP, but NOT
 # the public IP. So we get the list of created instances, and then we have
@@ -262,13 +400,32 @@ for seat in seats:
     for instance in seat['instances']:
         seat['addresses'].append(instances[instance])
 
+# "running" only means the instance has booted; cloud-init is still
+# installing packages and TiUP for a while after that. Students shouldn't
+# get hosts that are half set up, so wait until each one lets its seat's
+# key log in and cloud-init has finished.
+not_ready = []
+if not args.no_wait_ready:
+    launched = {inst['InstanceId']: inst['LaunchTime'].timestamp()
+            for r in instance_info['Reservations'] for inst in r['Instances']}
+    print('Waiting for all {} instances to be ready...'.format(len(instance_ids)), file=sys.stderr)
+    ready = readiness.wait_ready([{
+        'id': instance,
+        'host': instances[instance]['public'],
+        'launched': launched[instance],
+        'key': seat['key']['KeyMaterial'],
+        } for seat in seats for instance in seat['instances']], args.instance_ami_user,
+        max_connections=args.ready_connections, timeout=args.ready_timeout,
+        report=lambda *a: print(*a, file=sys.stderr, flush=True))
+    not_ready = [i for i in instance_ids if i not in ready]
+
 # This should be the only output to stdout, so that it can easily be
 # redirected to a file and used later to send connection information to
 # students.
 print( json.dumps({
     'course_id': args.course_id,
     'security_group': sg_id,
-    'subnet': subnet['SubnetId'],
+    'subnet': subnet_id,
     'seats': [
         {
             'key_name': s['key']['KeyName'],
@@ -278,3 +435,6 @@ print( json.dumps({
         } for s in seats
     ]
 }) )
+
+if not_ready:
+    sys.exit(1)
@@ -1,25 +1,188 @@
 #!/usr/bin/env python3
+'''
+instances-per-student.py reads the JSON output of create-instances.py from
+stdin and writes a bundle of files for each student into a directory named
+after the course ID: their private key (with their seat's details), an
+ssh_config snippet for their instances, and optionally an archive of both.
 
+The input is parsed as it arrives, so each student's bundle is written by a
+pool of threads as soon as their seat has been read, and every file is
+written to a temporary file and renamed into place, so that nothing ever
+sees a half-written bundle.
+'''
+
+import argparse
+import codecs
+import concurrent.futures
+import io
 import json
 import os
 import sys
+import tarfile
+import tempfile
+import zipfile
+
+parser = argparse.ArgumentParser(description='Write per-student files from the output of create-instances.py')
+parser.add_argument('--archive', choices=['zip', 'tar'],
+        help='Also write each student\'s files into a student-N.zip or student-N.tar.gz')
+parser.add_argument('--user', type=str, default='ubuntu',
+        help='The login user for the ssh_config snippets (default %(default)s)')
+parser.add_argument('--workers', type=int, default=16,
+        help='The number of bundles to write at the same time (default %(default)d)')
+
+args = parser.parse_args()
+
+decoder = json.JSONDecoder()
+
+def read_input(f, chunk_size=65536):
+    '''
+    read_input() parses the JSON object that create-instances.py writes as
+    it is read from the binary file f, yielding ('field', value) for each
+    top-level field and then ('seat', seat) for each entry of "seats" as
+    soon as all of it has been read
+    '''
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
 
-j = json.load(sys.stdin)
+    def more():
+        nonlocal buf, pos, eof
+        data = f.read1(chunk_size)
+        eof = not data
+        buf = buf[pos:] + text.decode(data, final=eof)
+        pos = 0
 
-course_id = j['course_id']
-seats = j['seats']
+    def skip(*chars):
+        # skip whitespace, then expect (and skip) one of chars
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf):
+                break
+            if eof:
+                raise ValueError('Unexpected end of input')
+            more()
+        if buf[pos] not in chars:
+            raise ValueError('Expected {} at "{}"'.format(' or '.join(chars), buf[pos:pos + 20]))
+        pos += 1
+        return buf[pos - 1]
 
-os.mkdir(course_id)
-os.chdir(course_id)
+    def value():
+        nonlocal pos
+        skip(*'{["-0123456789tfn')
+        pos -= 1
+        while True:
+            try:
+                result, end = decoder.raw_decode(buf, pos)
+                # a number that runs to the end of what we have so far
+                # might go on in the next chunk
+                if end < len(buf) or eof:
+                    pos = end
+                    return result
+            except ValueError:
+                if eof:
+                    raise
+            more()
 
+    skip('{')
+    if skip('}', '"') == '}':
+        return
+    pos -= 1
+    while True:
+        key = value()
+        skip(':')
+        if key == 'seats':
+            skip('[')
+            if skip(']', *'{["-0123456789tfn') != ']':
+                pos -= 1
+                while True:
+                    yield 'seat', value()
+                    if skip(',', ']') == ']':
+                        break
+        else:
+            yield key, value()
+        if skip(',', '}') == '}':
+            return
 
-for i, s in enumerate(seats):
+def write_atomic(path, data):
+    '''
+    write_atomic() writes data (bytes) to a temporary file next to path and
+    renames it to path, so path is either the old file or the new one
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=path + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def ssh_config(i, seat):
+    lines = []
+    for n, instance in enumerate(seat['instances'], 1):
+        lines += [
+            'Host student-{}-{}'.format(i, n),
+            '    HostName {}'.format(instance['public']),
+            '    User {}'.format(args.user),
+            '    IdentityFile student-{}.pem'.format(i),
+            '    IdentitiesOnly yes',
+            '',
+        ]
+    return '\n'.join(lines)
+
+def write_bundle(i, seat):
+    files = {
+        'student-{}.pem'.format(i): '{}\n{}\n'.format(seat['key'], json.dumps(seat, indent=4)),
+        'student-{}.ssh_config'.format(i): ssh_config(i, seat),
+    }
+    for name, content in files.items():
+        write_atomic(name, content.encode())
+
+    if args.archive == 'zip':
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name, content in files.items():
+                info = zipfile.ZipInfo('student-{}/{}'.format(i, name))
+                info.external_attr = 0o600 << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                z.writestr(info, content)
+        write_atomic('student-{}.zip'.format(i), archive.getvalue())
+    elif args.archive == 'tar':
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as t:
+            for name, content in files.items():
+                info = tarfile.TarInfo('student-{}/{}'.format(i, name))
+                info.size = len(content.encode())
+                info.mode = 0o600
+                t.addfile(info, io.BytesIO(content.encode()))
+        write_atomic('student-{}.tar.gz'.format(i), archive.getvalue())
+
+def enter_course_dir(course_id):
+    os.makedirs(course_id, exist_ok=True)
+    os.chdir(course_id)
+    # Everything in here has private keys or passwords in it
     os.umask(0o177)
-    with open('student-{}.pem'.format(i), 'w')  as f:
-        print(s['key'], file=f)
-        print(json.dumps(s, indent=4), file=f)
 
-with open('instances.json', 'w') as f:
-    json.dump(j, f, sort_keys=True, indent=4)
+j = {'seats': []}
+futures = []
+with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+    for key, item in read_input(sys.stdin.buffer):
+        if key != 'seat':
+            j[key] = item
+            continue
+        if not futures:
+            # create-instances.py writes the course ID before the seats
+            enter_course_dir(j['course_id'])
+        futures.append(executor.submit(write_bundle, len(j['seats']), item))
+        j['seats'].append(item)
+    for future in futures:
+        future.result()
+if not futures:
+    enter_course_dir(j['course_id'])
+
+write_atomic('instances.json', json.dumps(j, sort_keys=True, indent=4).encode())
 
-print(course_id)
+print(j['course_id'])
@@ -1,22 +1,115 @@
 #!/usr/bin/env python3
 
 import argparse
+import heapq
 import ipaddress
 import sys
 
 import boto3
 
-parser = argparse.ArgumentParser(description='Adjust existing security group to have ')
+import aws_inventory
+
+def ip_network(value):
+    '''
+    ip_network() is the type of the ip_address arguments, and also parses
+    the lines read from stdin. Host bits are allowed, so a bare address or
+    e.g. 192.0.2.17/24 both work.
+    '''
+    return ipaddress.ip_network(value.strip(), strict=False)
+
+def aggregate(networks, budget):
+    '''
+    aggregate() returns the fewest networks that cover all of networks
+    without granting access to more than budget addresses that aren't in
+    networks. Exact merges (two halves of a /N into the /N) are free; after
+    that, the cheapest merge into a covering supernet is made first, until
+    the next one would go over budget.
+    '''
+    blocks = list(ipaddress.collapse_addresses(networks))
+    # The blocks are kept as a linked list, and the cost of merging each pair
+    # of neighbours in a heap. A merge only changes the pairs next to it, so
+    # only those are recomputed. A pair further away can get cheaper too, if
+    # its supernet covers the merge, but then the new block and its neighbour
+    # inside that supernet are cheaper still, so the cheapest pair in the
+    # heap is always up to date. Pairs are checked again as they come off
+    # the heap, and ones that have gone or whose cost has changed are
+    # skipped or put back.
+    before_of = dict(zip(blocks[1:], blocks))
+    after_of = dict(zip(blocks, blocks[1:]))
+
+    def merge(left, right):
+        # The smallest supernet of two neighbours covers everything
+        # between them too, and the blocks in it are a contiguous run
+        supernet = left
+        while not supernet.supernet_of(right):
+            supernet = supernet.supernet()
+        first = left
+        while first in before_of and supernet.supernet_of(before_of[first]):
+            first = before_of[first]
+        run = [first]
+        while run[-1] in after_of and supernet.supernet_of(after_of[run[-1]]):
+            run.append(after_of[run[-1]])
+        return supernet.num_addresses - sum(b.num_addresses for b in run), supernet, run
+
+    def push(left, right):
+        heapq.heappush(heap, (merge(left, right)[0], left.network_address, left, right))
+
+    alive = set(blocks)
+    heap = []
+    for left, right in after_of.items():
+        push(left, right)
+    while heap:
+        cost, _, left, right = heapq.heappop(heap)
+        if after_of.get(left) != right:
+            continue
+        current, supernet, run = merge(left, right)
+        if current != cost:
+            heapq.heappush(heap, (current, left.network_address, left, right))
+            continue
+        if cost > budget:
+            break
+        budget -= cost
+        before, after = before_of.get(run[0]), after_of.get(run[-1])
+        for b in run:
+            before_of.pop(b, None)
+            after_of.pop(b, None)
+        alive.difference_update(run)
+        alive.add(supernet)
+        if before is not None:
+            after_of[before], before_of[supernet] = supernet, before
+            push(before, supernet)
+        if after is not None:
+            after_of[supernet], before_of[after] = after, supernet
+            push(supernet, after)
+    return sorted(alive)
+
+def chunks(items, size):
+    for n in range(0, len(items), size):
+        yield items[n:n + size]
+
+parser = argparse.ArgumentParser(description='Adjust existing security group to have ' +
+        'unrestricted access from a list of IP addresses')
 
 parser.add_argument('-s', '--security-group-id', type=str,
         help='The ID of the security group to modify', required=True)
+parser.add_argument('--over-grant', type=int, default=0,
+        help='The number of addresses that weren\'t asked for that may be ' +
+             'allowed (for each of IPv4 and IPv6) to merge nearby addresses into ' +
+             'fewer rules ' +
+             '(default %(default)d, only merge exactly adjacent ranges)')
+parser.add_argument('--sync', action='store_true',
+        help='Also revoke the addresses the security group allows that aren\'t in the list')
+parser.add_argument('--batch-size', type=int, default=100,
+        help='The most address ranges to send in each API call (default %(default)d)')
+parser.add_argument('--dry-run', action='store_true',
+        help='Only print the changes that would be made')
 
 '''
 parser.add_argument('--port', type=int, nargs='+',
         help='Port number(s) to open (default %(default)d)', default=[2379,3000,4000])
 '''
 
-parser.add_argument('ip_address', type=ipaddress.ip_interface, nargs='*')
+parser.add_argument('ip_address', type=ip_network, nargs='*')
 
 args = parser.parse_args()
 
@@ -24,55 +117,63 @@ print('Modifying security group {}'.format(args.security_group_id), file=sys.std
 
 ec2 = boto3.client('ec2')
 
-sg_info = ec2.describe_security_groups(GroupIds=[args.security_group_id])['SecurityGroups'][0]
+inventory = aws_inventory.Inventory(ec2)
+sg_info = inventory.load('security-group', GroupIds=[args.security_group_id])[0]
+existing = set()
 for ip_perms in sg_info['IpPermissions']:
     if ip_perms['IpProtocol'] == '-1':
-        existing_ipv4 = ip_perms['IpRanges']
-        existing_ipv6 = ip_perms['Ipv6Ranges']
-
-ipv4_ranges=[]
-ipv6_ranges=[]
+        existing.update(ipaddress.ip_network(r['CidrIp']) for r in ip_perms.get('IpRanges', []))
+        existing.update(ipaddress.ip_network(r['CidrIpv6']) for r in ip_perms.get('Ipv6Ranges', []))
 
 if not args.ip_address:
     print('Reading IP addresses from stdin', file=sys.stderr)
     for line in sys.stdin:
-        line = line.strip()
+        if not line.strip():
+            continue
         try:
-            args.ip_address.append(
-                    ipaddress.ip_network(line)
-                    )
+            args.ip_address.append(ip_network(line))
         except ValueError as e:
-            print('Error parsing address "{}" from stdin'.format(line), file=sys.stderr)
-
-for ip in args.ip_address:
-    cidr = ipaddress.ip_network(ip)
-    if type(cidr) == ipaddress.IPv4Network:
-        new_ip = {'CidrIp': str(cidr)}
-        if new_ip not in existing_ipv4:
-            ipv4_ranges.append(new_ip)
-        else:
-            print('IP {} already allowed to connect'.format(new_ip), file=sys.stderr)
-    elif type(cidr) == ipaddress.IPv6Network:
-        new_ip = {'CidrIpv6': str(cidr)}
-        if new_ip not in existing_ipv6:
-            ipv6_ranges.append(new_ip)
-        else:
-            print('IP {} already allowed to connect'.format(new_ip), file=sys.stderr)
-
-if not (ipv4_ranges or ipv6_ranges):
-    print('No new IPs to add', file=sys.stderr)
-    sys.exit(0)
+            print('Error parsing address "{}" from stdin'.format(line.strip()), file=sys.stderr)
+
+requested = set(args.ip_address)
+
+# Without --sync the rules that are already there stay as they are, and
+# anything they cover doesn't need a rule of its own
+if not args.sync:
+    for ip in sorted(requested, key=lambda ip: (ip.version, ip)):
+        covering = [e for e in existing if e.version == ip.version and e.supernet_of(ip)]
+        if covering:
+            print('IP {} already allowed to connect by {}'.format(ip, covering[0]), file=sys.stderr)
+            requested.discard(ip)
 
-sg_ingress_template = {
-        'GroupId': args.security_group_id,
-        'IpPermissions': [
-            {'IpProtocol': '-1',
-                'IpRanges': ipv4_ranges,
-                'Ipv6Ranges': ipv6_ranges,
-                }
-			],
-		}
+wanted = set()
+for version in (4, 6):
+    networks = [ip for ip in requested if ip.version == version]
+    if networks:
+        wanted.update(aggregate(networks, args.over_grant))
 
-print(sg_ingress_template, file=sys.stderr)
+to_add = sorted(wanted - existing, key=lambda ip: (ip.version, ip))
+to_revoke = sorted(existing - wanted, key=lambda ip: (ip.version, ip)) if args.sync else []
+
+print('{} addresses requested, {} rules after aggregation, {} to add, {} to revoke'.format(
+    len(args.ip_address), len(wanted), len(to_add), len(to_revoke)), file=sys.stderr)
+
+if not (to_add or to_revoke):
+    print('No changes to make', file=sys.stderr)
+    sys.exit(0)
 
-ec2.authorize_security_group_ingress(**sg_ingress_template)
+def ip_permissions(networks):
+    return [{'IpProtocol': '-1',
+        'IpRanges': [{'CidrIp': str(ip)} for ip in networks if ip.version == 4],
+        'Ipv6Ranges': [{'CidrIpv6': str(ip)} for ip in networks if ip.version == 6],
+        }]
+
+# Adding before revoking means an address that is moving into a bigger
+# range never loses access in between
+for action, networks, fn in [
+        ('Adding', to_add, ec2.authorize_security_group_ingress),
+        ('Revoking', to_revoke, ec2.revoke_security_group_ingress)]:
+    for chunk in chunks(networks, args.batch_size):
+        print('{} {}'.format(action, ', '.join(str(ip) for ip in chunk)), file=sys.stderr)
+        if not args.dry_run:
+            fn(GroupId=args.security_group_id, IpPermissions=ip_permissions(chunk))
@@ -0,0 +1 @@
+../aws_multi_az/readiness.py
\ No newline at end of file
@@ -0,0 +1,200 @@
+'''
+crockford.py converts hex strings (hashes, UUIDs without the dashes) to and
+from Douglas Crockford's base 32, in lower case, for the base32 script and
+anything else that wants to import it.
+
+Encoding goes through base64.b32encode and decoding through int(s, 32),
+with str.translate mapping between their alphabets and Crockford's, so
+neither loops over characters in Python.
+
+sql_encode() gives exactly what base32_encode() in base32.sql gives, which
+isn't always the same as encode(); see its docstring.
+'''
+
+import base64
+import functools
+import random
+import time
+
+ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz'
+
+# RFC 4648 base 32 digits -> Crockford's
+_from_b32 = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567', ALPHABET.encode())
+
+# Crockford's digits -> the digits int() uses for base 32 (0-9a-v). Upper
+# case, and i, l and o (which are read as 1, 1 and 0), are accepted too,
+# and dashes are ignored. u and _ mean something to int() but not to
+# Crockford, so they're turned into something int() will reject.
+_to_int = str.maketrans(
+        ALPHABET + ALPHABET.upper() + 'iloILOuU_',
+        '0123456789abcdefghijklmnopqrstuv' * 2 + '110110!!!',
+        '-')
+
+def encode(hexstring):
+    '''
+    encode() returns the base 32 form of the number in hexstring, with no
+    leading zeros (so the encoding of 0 is '')
+    '''
+    num = int(hexstring, 16)
+    # b32encode works on 5 bytes (8 digits) at a time, so pad the number
+    # out to that on the left and strip the zeros it gives back
+    size = -(-num.bit_length() // 40) * 5
+    return base64.b32encode(num.to_bytes(size, 'big')).translate(_from_b32).decode().lstrip('0')
+
+def decode(string):
+    '''
+    decode() returns the number in base 32 string as hex, with no leading
+    zeros (and '' is 0, the other way around from encode())
+    '''
+    digits = string.translate(_to_int)
+    return '{:x}'.format(int(digits, 32) if digits else 0)
+
+def sql_encode(hexstring):
+    '''
+    sql_encode() is encode() the way base32_encode() in base32.sql does it:
+    the hex is taken 15 digits (60 bits, 12 base 32 digits) at a time from
+    the end, and each chunk is encoded on its own. That's the same as
+    encode() except that
+      * leading zeros are dropped from every chunk, not just the first one,
+        so a chunk that starts with a 0 comes out short, and
+      * if the length is a multiple of 15 the first chunk is dropped
+        entirely (the last substr() asks for length % 15 characters).
+    Use this to match IDs that were generated in the database.
+    '''
+    length = len(hexstring)
+    offset = length
+    chunks = []
+    while offset > 0:
+        offset = offset - 15 if offset >= 15 else 0
+        chunk = hexstring[offset:offset + 15] if offset else hexstring[:length % 15]
+        chunks.append(encode(chunk) if chunk else '')
+    return ''.join(reversed(chunks))
+
+def convert_block(fn, block):
+    '''
+    convert_block() applies fn to each line of the string block and returns
+    the results as lines, and the number of lines that couldn't be converted
+    (which come out empty, so the output still lines up with the input).
+    Blank lines are left blank and aren't counted.
+    '''
+    results = []
+    failed = 0
+    for line in block.splitlines():
+        line = line.strip()
+        if not line:
+            results.append('')
+            continue
+        try:
+            results.append(fn(line))
+        except ValueError:
+            results.append('')
+            failed += 1
+    results.append('')
+    return '\n'.join(results), failed
+
+def convert_stream(fn, f, executor=None, jobs=1, block_size=1 << 20):
+    '''
+    convert_stream() converts each line of f with fn, yielding the results
+    of convert_block() for blocks of about block_size characters of whole
+    lines, in order. Given a process pool executor with jobs workers, the
+    blocks are converted in parallel; passing blocks of text instead of
+    lists of lines keeps the cost of sending them between processes down.
+    '''
+    def blocks():
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return
+            yield block + f.readline()
+
+    convert = functools.partial(convert_block, fn)
+    if executor is None:
+        yield from map(convert, blocks())
+        return
+    # Keep a bounded number of blocks in flight so that huge inputs aren't
+    # read into memory all at once
+    pending = []
+    for block in blocks():
+        pending.append(executor.submit(convert, block))
+        if len(pending) >= 4 * jobs:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+def self_test():
+    '''
+    self_test() checks the codec against the SQL function's own example and
+    known edge cases, and round-trips a lot of random values. It returns a
+    list of failures, which is empty if everything is OK.
+    '''
+    failures = []
+    def check(what, got, expected):
+        if got != expected:
+            failures.append('{}: got {!r}, expected {!r}'.format(what, got, expected))
+
+    # The example at the end of base32.sql
+    check('sql_encode(b35f2394...)', sql_encode('b35f2394eabe11e4b16d80e65018a9be'),
+            '5kbwhs9tny27jb2vc0ws81hady')
+    check('encode(b35f2394...)', encode('b35f2394eabe11e4b16d80e65018a9be'),
+            '5kbwhs9tny27jb2vc0ws81hady')
+    check('decode(5kbwhs9t...)', decode('5kbw-hs9t-ny27-jb2v-c0ws-81ha-dy'),
+            'b35f2394eabe11e4b16d80e65018a9be')
+    check('encode(0)', encode('0'), '')
+    check('encode(1f)', encode('1f'), 'z')
+    check('encode(20)', encode('20'), '10')
+    check('decode(ILO)', decode('ILO'), '{:x}'.format(32 * 32 + 32))
+    for bad in ['u', '1_0', 'x!']:
+        try:
+            decode(bad)
+            failures.append('decode({!r}) should have failed'.format(bad))
+        except ValueError:
+            pass
+    # The SQL function's quirks: zeros at the start of a chunk are lost,
+    # and so is the whole first chunk when the length is a multiple of 15
+    check('sql_encode(chunk starting with 0)', sql_encode('1' + '0' * 14 + '1'), '11')
+    check('sql_encode(30 digits)', sql_encode('f' * 30), encode('f' * 15))
+    check('sql_encode(empty)', sql_encode(''), '')
+
+    rng = random.Random(0)
+    for n in range(10000):
+        digits = rng.randrange(1, 65)
+        value = '{:x}'.format(rng.getrandbits(4 * digits))
+        check('decode(encode({}))'.format(value), decode(encode(value)), value)
+        check('sql_encode({})'.format(value), sql_encode(value), _sql_reference(value))
+    return failures
+
+def _sql_reference(hexstring):
+    # A line-by-line translation of base32_encode() from base32.sql
+    length = len(hexstring)
+    chu = 15
+    off = length
+    ret = ''
+    while off > 0:
+        off = off - chu if off >= chu else 0
+        part = hexstring[off:off + chu] if off else hexstring[0:length % chu]
+        inn = int(part, 16) if part else 0
+        while inn > 0:
+            wrk = inn & 31
+            ret = chr(wrk + 48 + (0 if wrk < 10 else 39) + (wrk > 17) + (wrk > 19)
+                    + (wrk > 21) + (wrk > 26)) + ret
+            inn = inn >> 5
+    return ret
+
+def benchmark(count=200000, digits=32):
+    '''
+    benchmark() times each conversion on count random values of digits hex
+    digits and returns a dict of name: conversions per second
+    '''
+    rng = random.Random(0)
+    values = ['{:0{}x}'.format(rng.getrandbits(4 * digits), digits) for _ in range(count)]
+    encoded = [encode(v) for v in values]
+    rates = {}
+    for name, fn, inputs in [
+            ('encode', encode, values),
+            ('sql_encode', sql_encode, values),
+            ('decode', decode, encoded)]:
+        start = time.perf_counter()
+        for v in inputs:
+            fn(v)
+        rates[name] = count / (time.perf_counter() - start)
+    return rates
@@ -1,34 +1,250 @@
 #!/usr/bin/env python3
 
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import multiprocessing
 import os
 import sys
+import tempfile
+import time
 import pycpdflib as pdf
 
-pdf.loadDLL("libpycpdf.so")
+def booklet_order(num_pages):
+    '''
+    booklet_order() is the order to print num_pages pages (a multiple of 4)
+    in so that they can be folded in half into a booklet
+    '''
+    pages=[]
+
+    i=0
+    while i < num_pages/2:
+        if i%2 == 1: pages.append(i+1)
+        pages.append(num_pages-i)
+        if i%2 == 0: pages.append(i+1)
+        i+=1
+
+    return pages
+
+def impose(source_filename, first, last, new_filename, linearize=False):
+    '''
+    impose() writes pages first to last of source_filename, padded to a
+    multiple of 4 and in booklet order, to new_filename. Only those pages
+    are read from the source, so memory use depends on the size of the
+    signature and not of the whole document.
+    '''
+    source_pdf = pdf.fromFileLazy(source_filename, '')
+    signature = pdf.selectPages(source_pdf, pdf.range(first, last))
+    pdf.padMultiple(signature, 4)
+    new_pdf = pdf.selectPages(signature, booklet_order(pdf.pages(signature)))
+    pdf.toFile(new_pdf, new_filename, linearize, linearize)
+    return new_filename
+
+def merge(parts, new_filename):
+    '''
+    merge() joins the imposed signatures in parts, in order, into new_filename
+    '''
+    new_pdf = pdf.mergeSimple([pdf.fromFileLazy(part, '') for part in parts])
+    pdf.toFile(new_pdf, new_filename, True, True)
+    return new_filename
+
+def booklet_filename(source_filename):
+    new_filename = os.path.splitext(source_filename)
+    new_filename = new_filename[0]+'_booklet'+new_filename[1]
+    if args.output_dir:
+        new_filename = os.path.join(args.output_dir, os.path.basename(new_filename))
+    return new_filename
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+hash_file = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'pdf_to_booklet', 'hashes.json')
+
+def read_hashes():
+    try:
+        with open(hash_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-source_filename = sys.argv[1]
-source_pdf = pdf.fromFile(source_filename, '')
-new_filename = os.path.splitext(source_filename)
-new_filename = new_filename[0]+'_booklet'+new_filename[1]
+def save_hashes(hashes):
+    os.makedirs(os.path.dirname(hash_file), exist_ok=True)
+    tmp = '{}.{}'.format(hash_file, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(hashes, f, indent=1)
+    os.replace(tmp, hash_file)
 
-pdf.padMultiple(source_pdf, 4)
+def up_to_date(source_filename, hashes):
+    '''
+    up_to_date() says whether the booklet for source_filename was already
+    made from the source as it is now, going by --check
+    '''
+    new_filename = booklet_filename(source_filename)
+    if args.force or not os.path.exists(new_filename):
+        return False
+    if args.check == 'mtime':
+        return os.path.getmtime(new_filename) >= os.path.getmtime(source_filename)
+    return hashes.get(os.path.abspath(new_filename)) == [file_hash(source_filename), args.signature]
 
-num_pages = pdf.pages(source_pdf)
-print(num_pages)
+def make_booklets(executor, sources):
+    '''
+    make_booklets() imposes all of sources at the same time in executor,
+    which is shared by the signatures of all of the files, and returns the
+    number of files that failed
+    '''
+    hashes = read_hashes() if args.check == 'hash' else {}
+    running = {}
+    parts = {}
+    parts_dirs = {}
+    failed = set()
+    for source_filename in sources:
+        if up_to_date(source_filename, hashes):
+            print('{}: up to date'.format(source_filename))
+            continue
+        new_filename = booklet_filename(source_filename)
+        try:
+            num_pages = pdf.pages(pdf.fromFileLazy(source_filename, ''))
+        except Exception as error:
+            print('{}: {}'.format(source_filename, error), file=sys.stderr)
+            failed.add(source_filename)
+            continue
+        print('{}: {} pages'.format(source_filename, num_pages))
 
-pages=[]
+        signature_size = args.signature or num_pages
+        signatures = [(first, min(first + signature_size - 1, num_pages))
+                for first in range(1, num_pages + 1, signature_size)]
+        if len(signatures) == 1:
+            running[executor.submit(impose, source_filename, 1, num_pages, new_filename, True)] = \
+                    (source_filename, 'booklet')
+            continue
+        # Each signature is imposed in a separate task, which opens the
+        # source itself and writes its part to a temporary file, and once
+        # they're all done the parts are joined up in order
+        parts_dirs[source_filename] = tempfile.TemporaryDirectory(
+                dir=os.path.dirname(os.path.abspath(new_filename)))
+        parts[source_filename] = []
+        for first, last in signatures:
+            part = os.path.join(parts_dirs[source_filename].name, '{}.pdf'.format(first))
+            parts[source_filename].append(part)
+            running[executor.submit(impose, source_filename, first, last, part)] = \
+                    (source_filename, 'part')
 
-i=0
-while i < num_pages/2:
-    if i%2 == 1: pages.append(i+1)
-    pages.append(num_pages-i)
-    if i%2 == 0: pages.append(i+1)
-    i+=1
+    while running:
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            source_filename, kind = running.pop(future)
+            if future.exception() is not None:
+                if source_filename not in failed:
+                    print('{}: {}'.format(source_filename, future.exception()), file=sys.stderr)
+                failed.add(source_filename)
+            elif kind == 'part':
+                if not any(s == source_filename for s, _ in running.values()) and \
+                        source_filename not in failed:
+                    running[executor.submit(merge, parts[source_filename],
+                        booklet_filename(source_filename))] = (source_filename, 'booklet')
+            else:
+                print(future.result())
+                if args.check == 'hash':
+                    hashes[os.path.abspath(future.result())] = [file_hash(source_filename),
+                            args.signature]
+            if source_filename in parts_dirs and \
+                    not any(s == source_filename for s, _ in running.values()):
+                parts_dirs.pop(source_filename).cleanup()
 
-page_order = ",".join(str(page) for page in pages)
+    if args.check == 'hash':
+        save_hashes(hashes)
+    return len(failed)
+
+def is_booklet(filename):
+    return os.path.splitext(filename)[0].endswith('_booklet')
+
+def watch(executor, directory):
+    '''
+    watch() polls directory for PDFs that don't have an up-to-date booklet
+    and makes one for each, waiting until a file has stopped changing
+    between two polls so that files still being copied in are left alone
+    '''
+    # This runs for a long time, probably with its output going to a log
+    sys.stdout.reconfigure(line_buffering=True)
+    print('Watching {} for PDFs'.format(directory))
+    last_seen = {}
+    handled = {}
+    while True:
+        seen = {}
+        for filename in glob.glob(os.path.join(directory, '*.pdf')):
+            if is_booklet(filename):
+                continue
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            seen[filename] = (stat.st_size, stat.st_mtime)
+        ready = sorted(f for f in seen if last_seen.get(f) == seen[f] != handled.get(f))
+        if ready:
+            make_booklets(executor, ready)
+            handled.update((f, seen[f]) for f in ready)
+        last_seen = seen
+        time.sleep(args.interval)
+
+parser = argparse.ArgumentParser(description='Reorder the pages of PDFs for printing as booklets')
+parser.add_argument('sources', nargs='*',
+        help='The PDFs (or glob patterns) to reorder; each result is written to <name>_booklet.pdf')
+parser.add_argument('-s', '--signature', type=int, default=0,
+        help='Fold every SIGNATURE pages (a multiple of 4, e.g. 16 or 32) into a separate ' +
+             'booklet, to be bound together, instead of folding the whole document ' +
+             'into one (default %(default)d, one booklet)')
+parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+        help='The number of signatures or files to impose at the same time (default %(default)d)')
+parser.add_argument('-o', '--output-dir', type=str,
+        help='Write the booklets here instead of next to their sources')
+parser.add_argument('--check', choices=['mtime', 'hash'], default='mtime',
+        help='Skip sources whose booklet is newer than they are (mtime), or that ' +
+             'haven\'t changed since their booklet was made (hash) (default %(default)s)')
+parser.add_argument('-f', '--force', action='store_true',
+        help='Make the booklets even if they are up to date')
+parser.add_argument('-w', '--watch', type=str, metavar='DIR',
+        help='Keep running, and make booklets of the PDFs that are put into DIR')
+parser.add_argument('--interval', type=float, default=5,
+        help='Seconds between looking for new files in --watch DIR (default %(default)g)')
+
+args = parser.parse_args()
+
+if args.signature < 0 or args.signature % 4:
+    parser.error('--signature must be a multiple of 4')
+if not (args.sources or args.watch):
+    parser.error('give some PDFs or --watch')
+
+sources = []
+for pattern in args.sources:
+    # Patterns are expanded here too, for when the list is too long for
+    # the shell or it was quoted
+    if any(c in pattern for c in '*?['):
+        sources += [m for m in sorted(glob.glob(pattern)) if not is_booklet(m)]
+    else:
+        sources.append(pattern)
+
+# The library is loaded once, before the workers are forked, so each of
+# them has it without loading it again
+pdf.loadDLL("libpycpdf.so")
 
-r = pdf.parsePagespec(source_pdf, page_order)
+if args.output_dir:
+    os.makedirs(args.output_dir, exist_ok=True)
 
-new_pdf = pdf.selectPages(source_pdf, r)
+with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers,
+        mp_context=multiprocessing.get_context('fork')) as executor:
+    failed = make_booklets(executor, sources)
+    if args.watch:
+        try:
+            watch(executor, args.watch)
+        except KeyboardInterrupt:
+            pass
 
-pdf.toFile(new_pdf, new_filename, True, True)
+if failed:
+    sys.exit(1)
@@ -0,0 +1,46 @@
+#!/usr/bin/env perl
+# Tests for deltas; run with: prove t/
+use strict;
+use warnings;
+use File::Basename qw(dirname);
+use File::Temp qw(tempfile);
+use Test::More;
+
+my $deltas = dirname(__FILE__) . '/../deltas';
+
+# Two snapshots as mysqladmin -i1 extended-status prints them, piped through tr -d '|'
+my $snapshot = <<'END';
++-----------------------------------+------------+
+ Variable_name                      Value      
++-----------------------------------+------------+
+ Aborted_clients                    %d         
+ Bytes_received                     %d         
+ Com_select                         %d         
+ Uptime                             %d         
++-----------------------------------+------------+
+END
+
+sub run_deltas {
+    my ($input, @args) = @_;
+    my ($fh, $file) = tempfile(UNLINK => 1);
+    print $fh $input;
+    close $fh;
+    return scalar `perl $deltas @args < $file`;
+}
+
+my $input = sprintf($snapshot, 3, 1000, 50, 100) . sprintf($snapshot, 3, 1800, 70, 101);
+
+my $out = run_deltas($input, '-f');
+like($out, qr/^Bytes_received\t\+800$/m, '-f prints the change in each key');
+like($out, qr/^Com_select\t\+20$/m, '-f prints every key that changed');
+like($out, qr/^Aborted_clients\t\+0$/m, '-f prints keys that did not change');
+unlike($out, qr/Variable_name|\+-/, 'table borders and headers are skipped');
+
+$out = run_deltas($input, '-f', '-Z', '-t', 1);
+is($out, "\nBytes_received\t+800\n", '-Z -t shows only the biggest change');
+
+$out = run_deltas($input, '-r', '-u', 'Uptime', '-Z');
+like($out, qr/^Bytes_received\t\+800\.0$/m, '-r -u divides by the counter');
+unlike($out, qr/^Uptime/m, 'the time counter is left out of -Z');
+
+done_testing();